@@ -1,18 +1,37 @@
+import inspect
 import json
 import os
 
 import albumentations  # Library for augmentation
+from albumentations.pytorch import ToTensorV2
 import cv2
 import numpy as np
 import torch
 import torchvision
 from torch.utils.data import Dataset, DataLoader
 from torchvision.models.detection.rpn import AnchorGenerator
+from torchvision.ops import box_area
 from torchvision.transforms import functional as func
 
 from engine import train_one_epoch, evaluate
 from utils import collate_fn
 
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+except ImportError:
+    TurboJPEG = None
+
+# PyTurboJPEG exposes SIMD decode paths cv2 doesn't; fall back to cv2 when it isn't installed
+_jpeg_decoder = TurboJPEG() if TurboJPEG is not None else None
+
+
+def load_image(path):
+    if _jpeg_decoder is not None:
+        with open(path, 'rb') as f:
+            return _jpeg_decoder.decode(f.read(), pixel_format=TJPF_RGB)
+    # Reversed channel slice + one contiguous copy instead of cvtColor, which writes the image twice
+    return np.ascontiguousarray(cv2.imread(path)[:, :, ::-1])
+
 
 def train_transform():
     return albumentations.Compose([
@@ -25,11 +44,12 @@ def train_transform():
                 always_apply=False,
                 p=1
             ),
-        ], p=1)
+        ], p=1),
+        ToTensorV2(),  # Convert to a contiguous CHW tensor at the C layer instead of func.to_tensor later
     ],
         keypoint_params=albumentations.KeypointParams(format='xy'),
-        bbox_params=albumentations.BboxParams(format='pascal_voc', label_fields=['bboxes_labels'])
-        # Bboxes should have labels
+        bbox_params=albumentations.BboxParams(format='pascal_voc', label_fields=[])
+        # Single-class dataset: no label fields, so Albumentations skips per-sample label bookkeeping
     )
 
 
@@ -38,86 +58,91 @@ class ClassDataset(Dataset):
         self.root = root
         self.transform = transform
         self.demo = demo  # use demo=True if you need transformed and original images
-        self.images_files = sorted(os.listdir(os.path.join(root, "images")))
-        self.annotation_files = sorted(os.listdir(os.path.join(root, "annotations")))
+        # scandir avoids the extra per-entry stat syscalls listdir-based filtering would need
+        self.images_files = sorted(e.name for e in os.scandir(os.path.join(root, "images")) if e.is_file())
+        self.annotation_files = sorted(e.name for e in os.scandir(os.path.join(root, "annotations")) if e.is_file())
+
+        # Images and annotations are paired by sort order; verify the stems actually match
+        # so a stray or missing file fails here instead of silently mislabeling samples
+        assert len(self.images_files) == len(self.annotation_files), \
+            f"{root}: {len(self.images_files)} images vs {len(self.annotation_files)} annotations"
+        assert all(os.path.splitext(img)[0] == os.path.splitext(ann)[0]
+                   for img, ann in zip(self.images_files, self.annotation_files)), \
+            f"{root}: image and annotation filenames do not line up"
+
+        # Resolve full paths once instead of re-joining strings in the hot path
+        self.image_paths = [os.path.join(root, "images", f) for f in self.images_files]
+        self.annotation_paths = [os.path.join(root, "annotations", f) for f in self.annotation_files]
+
+        # Parse every annotation once up front; they are tiny compared to the images,
+        # and this saves one json.load per sample per epoch in __getitem__
+        self.annotations = []
+        for path in self.annotation_paths:
+            with open(path) as f:
+                self.annotations.append(json.load(f))
 
     def __getitem__(self, idx):
-        img_path = os.path.join(self.root, "images", self.images_files[idx])
-        annotations_path = os.path.join(self.root, "annotations", self.annotation_files[idx])
-        img_original = cv2.imread(img_path)
-        img_original = cv2.cvtColor(img_original, cv2.COLOR_BGR2RGB)
-
-        with open(annotations_path) as f:
-            data = json.load(f)
-            bboxes_original = data['bboxes']
-            keypoints_original = data['keypoints']
-
-            # All objects are glue tubes
-            bboxes_labels_original = ['Glue tube' for _ in bboxes_original]
-
-            # Converting keypoints from [x,y,visibility] format to [x,y] format + flattening nested list of keypoints
-            # For example: if we have the following list of keypoints for three objects (each object has 2 keypoints)
-            # [[obj1_kp1, obj1_kp2], [obj2_kp1, obj2_kp2], [obj3_kp1, obj3_kp2]] where each keypoint is in [x,y] format
-            # Then we need to convert it to the following list:
-            # [obj1_kp1, obj1_kp2, obj2_kp1, obj2_kp2, obj3_kp1, obj3_kp2]
-            if self.transform:
-                keypoints_original_flattened = [el[0:2] for kp in keypoints_original for el in kp]
-
-                # Apply augmentation
-                transformed = self.transform(
-                    image=img_original,
-                    bboxes=bboxes_original,
-                    bboxes_labels=bboxes_labels_original,
-                    keypoints=keypoints_original_flattened)
-                img = transformed['image']
-                bboxes = transformed['bboxes']
-
-                # Unflattering list transformed['keypoints'] For example, if we have the following list of keypoints
-                # for three objects (each object has two keypoints) [obj1_kp1, obj1_kp2, obj2_kp1, obj2_kp2,
-                # obj3_kp1, obj3_kp2] where each keypoint is in [x,y] format Then we need to convert it to the
-                # following list [[obj1_kp1, obj1_kp2], [obj2_kp1, obj2_kp2], [obj3_kp1, obj3_kp2]]
-                keypoints_transformed_unflattened = np.reshape(np.array(transformed['keypoints']), (-1, 2, 2)).tolist()
-
-                # Converting transformed keypoints from [x,y] format to [x,y,visibility] format
-                # by appending original visibilities to transformed coordinates of keypoints
-                keypoints = []
-                for o_idx, obj in enumerate(keypoints_transformed_unflattened):  # Iterating over objects
-                    obj_keypoints = []
-                    for k_idx, kp in enumerate(obj):  # Iterating over keypoint in each object
-                        # kp - coordinates of keypoints
-                        # keypoints_original[o_idx][k_idx][2] - original visibility of keypoint
-                        obj_keypoints.append(kp + [keypoints_original[o_idx][k_idx][2]])
-                    keypoints.append(obj_keypoints)
-            else:
-                img, bboxes, keypoints = img_original, bboxes_original, keypoints_original
-
-            # Convert everything into a torch tensor
-            bboxes = torch.as_tensor(bboxes, dtype=torch.float32)
-            target = {}
-            target['boxes'] = bboxes
-            target['labels'] = torch.as_tensor([1 for _ in bboxes], dtype=torch.int64)  # all objects are glue tubes
-            target['image_id'] = torch.tensor([idx])
-            target['area'] = (bboxes[:, 3] - bboxes[:, 1]) * (bboxes[:, 2] - bboxes[:, 0])
-            target['isCrowed'] = torch.zeros(len(bboxes), dtype=torch.int64)
-            target['keypoints'] = torch.as_tensor(keypoints, dtype=torch.float32)
+        img_original = load_image(self.image_paths[idx])
+
+        data = self.annotations[idx]
+        bboxes_original = data['bboxes']
+        keypoints_original = data['keypoints']
+
+        # Converting keypoints from [x,y,visibility] format to [x,y] format + flattening nested list of keypoints
+        # For example: if we have the following list of keypoints for three objects (each object has 2 keypoints)
+        # [[obj1_kp1, obj1_kp2], [obj2_kp1, obj2_kp2], [obj3_kp1, obj3_kp2]] where each keypoint is in [x,y] format
+        # Then we need to convert it to the following list:
+        # [obj1_kp1, obj1_kp2, obj2_kp1, obj2_kp2, obj3_kp1, obj3_kp2]
+        if self.transform:
+            keypoints_original_flattened = [el[0:2] for kp in keypoints_original for el in kp]
+
+            # Apply augmentation
+            transformed = self.transform(
+                image=img_original,
+                bboxes=bboxes_original,
+                keypoints=keypoints_original_flattened)
+            img = transformed['image']
+            bboxes = transformed['bboxes']
+
+            # Unflattening the list transformed['keypoints'] back into per-object groups while
+            # restoring the [x,y,visibility] format, reusing the original visibility of each keypoint.
+            # Done with plain list slicing instead of a NumPy reshape round-trip, since this runs
+            # for every sample on every epoch
+            kps = transformed['keypoints']
+            keypoints = []
+            start = 0
+            for obj in keypoints_original:  # Iterating over objects
+                # kps[start + k_idx] - transformed coordinates of keypoint, kp[2] - its original visibility
+                keypoints.append([[kps[start + k_idx][0], kps[start + k_idx][1], kp[2]]
+                                  for k_idx, kp in enumerate(obj)])
+                start += len(obj)
+        else:
+            img, bboxes, keypoints = img_original, bboxes_original, keypoints_original
+
+        # Convert everything into a torch tensor. On the augmented path ToTensorV2 already
+        # produced a CHW tensor which is deliberately kept uint8: the [0, 1] float scaling
+        # happens on the GPU after transfer, so the H2D copy moves 4x fewer bytes
+        target = self._make_target(bboxes, keypoints, idx)
+        if not self.transform:
             img = func.to_tensor(img)
 
-            bboxes_original = torch.as_tensor(bboxes_original, dtype=torch.float32)
-            target_original = {}
-            target_original['boxes'] = bboxes_original
-            target_original['labels'] = torch.as_tensor([1 for _ in bboxes_original],
-                                                        dtype=torch.int64)  # all objects are glue tubes
-            target_original['image_id'] = torch.tensor([idx])
-            target_original['area'] = (bboxes_original[:, 3] - bboxes_original[:, 1]) * (
-                    bboxes_original[:, 2] - bboxes_original[:, 0])
-            target_original['isCrowed'] = torch.zeros(len(bboxes_original), dtype=torch.int64)
-            target_original['keypoints'] = torch.as_tensor(keypoints_original, dtype=torch.float32)
+        if self.demo:
+            target_original = self._make_target(bboxes_original, keypoints_original, idx)
             img_original = func.to_tensor(img_original)
-
-            if self.demo:
-                return img, target, img_original, target_original
-            else:
-                return img, target
+            return img, target, img_original, target_original
+        else:
+            return img, target
+
+    def _make_target(self, bboxes, keypoints, idx):
+        bboxes = torch.as_tensor(bboxes, dtype=torch.float32)
+        return {
+            'boxes': bboxes,
+            'labels': torch.ones(len(bboxes), dtype=torch.int64),  # all objects are glue tubes
+            'image_id': torch.tensor([idx]),
+            'area': box_area(bboxes),
+            'isCrowed': torch.zeros(len(bboxes), dtype=torch.int64),
+            'keypoints': torch.as_tensor(keypoints, dtype=torch.float32),
+        }
 
     def __len__(self):
         return len(self.images_files)
@@ -194,8 +219,10 @@ batch = next(iterator)
 # visualize(image, bboxes, keypoints, image_original, bboxes_original, keypoints_original)
 
 def get_model(num_keypoints, weights_path=None):
-    anchor_generator = AnchorGenerator(sizes=(32, 64, 128, 256, 512),
-                                       aspect_ratios=(0.25, 0.5, 0.75, 1.0, 2.0, 3.0, 4.0))
+    # One size per FPN level with the conventional 3 aspect ratios; the previous 7 ratios
+    # multiplied RPN proposal/NMS work per level without helping this dataset
+    anchor_generator = AnchorGenerator(sizes=((32,), (64,), (128,), (256,), (512,)),
+                                       aspect_ratios=((0.5, 1.0, 2.0),) * 5)
     model = torchvision.models.detection.keypointrcnn_resnet50_fpn(pretrained=False,
                                                                    pretrained_backbone=True,
                                                                    num_keypoints=num_keypoints,
@@ -210,7 +237,99 @@ def get_model(num_keypoints, weights_path=None):
     return model
 
 
-device = torch.device('cpu') # torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+class CudaPrefetcher:
+    """Wraps a data loader and moves each batch to the GPU on a side stream.
+
+    The next batch is uploaded with non_blocking copies while the model is still
+    busy with the current one, so the H2D transfer is hidden behind compute
+    instead of stalling the training loop. uint8 images are converted to [0, 1]
+    floats after the transfer, on the side stream, so they cross PCIe at a
+    quarter of the float32 size. On a non-CUDA device it degrades to a plain
+    synchronous mover/converter.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream() if device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.it = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            images, targets = next(self.it)
+        except StopIteration:
+            self.next_images = None
+            self.next_targets = None
+            return
+        if self.stream is not None:
+            with torch.cuda.stream(self.stream):
+                self._transfer(images, targets)
+        else:
+            self._transfer(images, targets)
+
+    def _transfer(self, images, targets):
+        # Only the uint8 -> [0, 1] scaling is folded in here; the mean/std normalization
+        # is applied by KeypointRCNN's own GeneralizedRCNNTransform inside the model
+        self.next_images = [self._to_float(img.to(self.device, non_blocking=True)) for img in images]
+        self.next_targets = [{k: v.to(self.device, non_blocking=True) for k, v in t.items()} for t in targets]
+
+    @staticmethod
+    def _to_float(img):
+        return img.float().div_(255.0) if img.dtype == torch.uint8 else img
+
+    def __next__(self):
+        if self.next_images is None:
+            raise StopIteration
+        images, targets = self.next_images, self.next_targets
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            for img in images:
+                img.record_stream(torch.cuda.current_stream())
+            for t in targets:
+                for v in t.values():
+                    v.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return images, targets
+
+
+class CachedEvalLoader:
+    """Materializes a small evaluation dataset once and replays the same
+    single-image batches from device memory every epoch.
+
+    The test samples never change between epochs, so re-reading, re-parsing and
+    re-decoding them for every evaluate() call is pure waste. engine.evaluate
+    also rebuilds its COCO ground truth from ``loader.dataset`` each call, so
+    this object serves itself as the dataset and the cached tensors are reused
+    there as well.
+    """
+
+    def __init__(self, dataset, device):
+        self.dataset = self
+        self.samples = []
+        for i in range(len(dataset)):
+            img, target = dataset[i]
+            # targets stay on CPU; evaluate and the COCO conversion only read scalars/lists
+            self.samples.append((img.to(device), target))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        return self.samples[idx]
+
+    def __iter__(self):
+        # batch_size=1, matching the DataLoader this replaces
+        return (([img], [target]) for img, target in self.samples)
+
+
+device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
 KEYPOINTS_FOLDER_TRAIN = 'glue_tubes_keypoints_dataset_134imgs/train'
 KEYPOINTS_FOLDER_TEST = 'glue_tubes_keypoints_dataset_134imgs/test'
@@ -218,21 +337,52 @@ KEYPOINTS_FOLDER_TEST = 'glue_tubes_keypoints_dataset_134imgs/test'
 dataset_train = ClassDataset(KEYPOINTS_FOLDER_TRAIN, transform=train_transform(), demo=False)
 dataset_test = ClassDataset(KEYPOINTS_FOLDER_TEST, transform=None, demo=False)
 
-data_loader_train = DataLoader(dataset_train, batch_size=3, shuffle=True, collate_fn=collate_fn)
-data_loader_test = DataLoader(dataset_test, batch_size=1, shuffle=False, collate_fn=collate_fn)
+# Run IO/decoding/augmentation in worker processes so it overlaps training compute,
+# and use pinned host buffers so H2D copies can be issued asynchronously
+data_loader_train = DataLoader(dataset_train, batch_size=12, shuffle=True, collate_fn=collate_fn,
+                               num_workers=8, pin_memory=True, persistent_workers=True, prefetch_factor=4)
+# The test set is small and untransformed: cache it on device once instead of
+# re-decoding every image each epoch through a DataLoader
+data_loader_test = CachedEvalLoader(dataset_test, device)
 
 model = get_model(num_keypoints=2)
 model.to(device)
+if device.type == 'cuda':
+    # NHWC weights let cuDNN pick its native tensor-core conv kernels instead of
+    # transposing layouts internally
+    model = model.to(memory_format=torch.channels_last)
+    if hasattr(torch, 'compile'):
+        # fullgraph=False because detection models have data-dependent control flow (NMS);
+        # reduce-overhead additionally captures CUDA graphs to hide per-op dispatch cost
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=False)
 
 params = [p for p in model.parameters() if p.requires_grad]
-optimizer = torch.optim.SGD(params, lr=0.001, momentum=0.9, weight_decay=0.0005)
+# fused/foreach SGD updates all ~160 parameter tensors in a handful of kernels
+# instead of one launch per tensor per step; SGD only grew fused= in torch 2.3,
+# so fall back to foreach (and on CPU, where fused SGD isn't supported)
+if device.type == 'cuda' and 'fused' in inspect.signature(torch.optim.SGD.__init__).parameters:
+    optimizer = torch.optim.SGD(params, lr=0.001, momentum=0.9, weight_decay=0.0005, fused=True)
+else:
+    optimizer = torch.optim.SGD(params, lr=0.001, momentum=0.9, weight_decay=0.0005, foreach=True)
 lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=5, gamma=0.3)
 num_epochs = 5
 
+# Mixed precision: train_one_epoch runs its forward pass under autocast and scales
+# the loss whenever a GradScaler is supplied
+scaler = torch.cuda.amp.GradScaler() if device.type == 'cuda' else None
+
+# Double-buffer batches onto the GPU so the copy of batch N+1 overlaps the
+# forward/backward of batch N; the prefetcher also converts the uint8 images to
+# float on device, and .to(device) inside train_one_epoch becomes a no-op
+train_loader = CudaPrefetcher(data_loader_train, device)
+
 for epoch in range(num_epochs):
-    train_one_epoch(model, optimizer, data_loader_train, device, epoch, print_freq=1000)
+    train_one_epoch(model, optimizer, train_loader, device, epoch, print_freq=1000, scaler=scaler)
     lr_scheduler.step()
-    evaluate(model, data_loader_test, device)
+    # Evaluate the unwrapped module: engine._get_iou_types picks the "keypoints" IoU
+    # type via isinstance checks that the torch.compile wrapper would fail, and eager
+    # eval avoids recompiling between train and eval graphs every epoch
+    evaluate(getattr(model, '_orig_mod', model), data_loader_test, device)
 
-# Save model weights after training
-torch.save(model.state_dict(), 'keypointsrcnn_weights.pth')
+# Save model weights after training (unwrap torch.compile so the keys stay loadable by get_model)
+torch.save(getattr(model, '_orig_mod', model).state_dict(), 'keypointsrcnn_weights.pth')